@@ -1,16 +1,18 @@
 import streamlit as st
 st.set_page_config(layout="wide")
 from PIL import Image
-import base64
-import requests
-import io
 import random
-import json
-import emd
-from emd.sdk.invoke.vlm_invoker import VLMInvoker
-from emd.sdk.invoke.conversation_invoker import ConversationInvoker
+import time
+import orjson
+import functools
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 CARD_VALUES = ['2', '3', '4', '5', '6', '7', '8', '9', 'J', 'Q', 'K', 'A']
+CARD_RANK = {v: i for i, v in enumerate(CARD_VALUES)}
+VALID_CARDS = frozenset(CARD_VALUES)
+# Spellings the VLM may use for a card, after strip().upper()
+CARD_ALIASES = {'JACK': 'J', 'QUEEN': 'Q', 'KING': 'K', 'ACE': 'A', '1': 'A'}
 
 # Default model settings
 DEFAULT_LLM_MODEL_ID = 'DeepSeek-R1-Distill-Qwen-32B'
@@ -29,6 +31,17 @@ VLM_MODEL_OPTIONS = {
     'gemma-3-27b-it': 'dev'
 }
 
+# Fixed rules for the LLM player, kept identical across turns so the
+# server can reuse the cached prefix
+SYSTEM_PROMPT = (
+    "You are the AI in a 5-round card game. Each side holds 5 cards; "
+    "ranks low to high: " + " ".join(CARD_VALUES) + ". "
+    "Each round the human plays first, then you play one card from your hand; "
+    "higher rank wins the round. Win more rounds than the human. "
+    "Input: {\"human\": played card, \"ai\": your hand, \"scores\": {\"h\": human, \"a\": ai}}. "
+    "Reply with strict JSON only: {\"card\": \"<card>\"}"
+)
+
 previous_selected_llm = ''
 
 # Initialize model settings in session state if not present
@@ -42,29 +55,22 @@ if 'vlm_model_tag' not in st.session_state:
     st.session_state.vlm_model_tag = DEFAULT_VLM_MODEL_TAG
 
 def deal_cards():
-    # Create single deck with unique cards
-    deck = CARD_VALUES.copy()
-    random.shuffle(deck)
-    
-    # Deal 5 unique cards to each player from same deck
-    human_cards = deck[:5]
-    ai_cards = deck[5:10]
-    
-    # Verify no duplicates between players
-    if len(set(human_cards + ai_cards)) != 10:
-        raise ValueError("Duplicate cards detected between players")
-    
-    return human_cards, ai_cards
+    # Deal 5 unique cards to each player from a single deck
+    cards = random.sample(CARD_VALUES, 10)
+    return cards[:5], cards[5:]
 
 # Initialize session state
 if 'human_cards' not in st.session_state:
-    st.session_state.human_cards, st.session_state.ai_cards = deal_cards()
+    # Hands are sets, display order comes from sorting by rank
+    human_cards, ai_cards = deal_cards()
+    st.session_state.human_cards = set(human_cards)
+    st.session_state.ai_cards = set(ai_cards)
 if 'table_cards' not in st.session_state:
     st.session_state.table_cards = []
 if 'scores' not in st.session_state:
     st.session_state.scores = {'human': 0, 'ai': 0}
 
-# Card display CSS
+# Card and stream container CSS
 card_style = """
 <style>
 .card {
@@ -88,25 +94,59 @@ card_style = """
     text-align: center;
     color: #333333;
 }
+.stream-container {
+    height: 500px;
+    overflow-y: auto;
+    border: 1px solid #ddd;
+    padding: 10px;
+    border-radius: 5px;
+    background-color: #f9f9f9;
+}
 </style>
 """
 
+@st.cache_resource
+def get_vlm(model_id, model_tag):
+    # Shared across reruns so client setup and auth happen once per model.
+    # The SDK is imported here to keep it off the script's import path.
+    from emd.sdk.invoke.vlm_invoker import VLMInvoker
+    return VLMInvoker(model_id, model_tag)
+
+@st.cache_resource
+def get_llm(model_id, model_tag):
+    from emd.sdk.invoke.conversation_invoker import ConversationInvoker
+    return ConversationInvoker(model_id, model_tag)
+
+@st.cache_resource
+def get_decision_cache():
+    # LLM answers keyed by model and game state, shared by all sessions
+    return {}
+
+def get_session_llm():
+    # One conversation per session so every turn shares the system prompt prefix.
+    # The copy reuses the cached service client but owns its message list.
+    key = (st.session_state.llm_model_id, st.session_state.llm_model_tag)
+    if st.session_state.get('llm_invoker_key') != key:
+        invoker = copy.copy(get_llm(*key))
+        # Set directly since add_system_message in the SDK passes insert() its args reversed
+        invoker.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        st.session_state.llm_invoker = invoker
+        st.session_state.llm_invoker_key = key
+    return st.session_state.llm_invoker
+
 def display_card(value):
-    return f"""
-    <div class="card">
-        <div class="card-value">{value}</div>
-    </div>
-    """
-
-def recognize_card(image):
-    # Convert image to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    # Save the image to a temp local path
-    temp_image_path = "/tmp/temp_card_image.png"
-    image.save(temp_image_path, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    invoker = VLMInvoker(st.session_state.vlm_model_id, st.session_state.vlm_model_tag)
+    return f'<div class="card"><div class="card-value">{value}</div></div>'
+
+def recognize_card(image, model_id, model_tag):
+    # Model settings are passed in since this runs off the script thread
+    # A card glyph only needs a few hundred pixels, shrink the camera frame
+    image = image.convert("RGB")
+    image.thumbnail((512, 512), Image.LANCZOS)
+    # Save the image to a temp local path, the invoker only accepts file paths.
+    # The extension becomes the data URL mime type, so use .jpeg not .jpg
+    temp_image_path = "/tmp/temp_card_image.jpeg"
+    image.save(temp_image_path, format="JPEG", quality=85)
+    invoker = get_vlm(model_id, model_tag)
     invoker.add_image(temp_image_path)
     # prompt = f"""你是一个人工智能扑克牌机器人，游戏开始时你和人类各有随机5张牌。
     # 游戏一共五局，每局都是人类先出，你之后出牌。
@@ -119,41 +159,84 @@ def recognize_card(image):
     invoker.add_user_message(prompt)
     ret = invoker.invoke()
     print(ret)
-    return ret
-
-def ai_decision(human_card, ai_cards):
-    # Prepare prompt for QwQ-32B
-    prompt = f"""你是一个人工智能扑克牌机器人，游戏开始时你和人类各有随机5张牌。
-    游戏一共五局，每局都是人类先出，你之后出牌。
-    每局的规则都是按扑克牌上的数字比大小决定输赢。最后按5局中谁赢的总数多获胜。
-    请考虑必要的策略，使你赢的总局数大于人类。
-    现在，人类出牌是 {human_card}.
-    你手上所有的牌是: {', '.join(ai_cards)}，你需要选择出一张牌。
-    只需要返回 json 格式如下 {{"card": "A"}}."""
+    card = ret.strip().strip('.\'"`').upper()
+    card = CARD_ALIASES.get(card, card)
+    return card if card in VALID_CARDS else None
+
+def _parse_card_json(text):
+    # Returns the parsed object if text is a {"card": ...} object, else None
+    try:
+        obj = orjson.loads(text.replace("'", '"'))
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(obj, dict) and 'card' in obj:
+        return obj
+    return None
+
+def _forced_move(human_card, ai_cards, human_remaining):
+    # ai_cards is sorted by rank. Returns the card to play when the later
+    # rounds are already decided, else None
+    if len(ai_cards) == 1:
+        return ai_cards[0]
+    human_ranks = [CARD_RANK[c] for c in human_remaining]
+    if max(human_ranks) < CARD_RANK[ai_cards[0]] or min(human_ranks) > CARD_RANK[ai_cards[-1]]:
+        # Every later round is won (or lost) whatever is kept, so take this
+        # round as cheaply as possible and otherwise sacrifice the lowest card
+        human_value = CARD_RANK[human_card]
+        return next((c for c in ai_cards if CARD_RANK[c] > human_value), ai_cards[0])
+    return None
+
+def ai_decision(human_card, ai_cards, human_remaining, scores):
+    ai_cards = sorted(ai_cards, key=CARD_RANK.get)
+    # Rules live in SYSTEM_PROMPT, each turn only sends the game state
+    prompt = orjson.dumps({
+        "human": human_card,
+        "ai": ai_cards,
+        "scores": {"h": scores['human'], "a": scores['ai']}
+    }).decode()
     
     print(prompt)
+    invoker = get_session_llm()
+
+    # Skip the model on forced moves, or reuse the answer for a game state
+    # this model has already seen
+    cache = get_decision_cache()
+    cache_key = (
+        st.session_state.llm_model_id, st.session_state.llm_model_tag,
+        human_card, tuple(ai_cards), scores['human'], scores['ai']
+    )
+    chosen_card = _forced_move(human_card, ai_cards, human_remaining) or cache.get(cache_key)
+    if chosen_card is not None:
+        invoker.add_user_message(prompt)
+        invoker.add_assistant_message(orjson.dumps({"card": chosen_card}).decode())
+        return chosen_card
+
     # Create stream container with scrollbar
-    st.markdown("""
-    <style>
-    .stream-container {
-        height: 500px;
-        overflow-y: auto;
-        border: 1px solid #ddd;
-        padding: 10px;
-        border-radius: 5px;
-        background-color: #f9f9f9;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
     stream_container = st.container()
     with stream_container:
         stream_placeholder = st.empty()
     
+    def render_stream(text):
+        # Update content with enhanced auto-scroll JavaScript
+        stream_placeholder.markdown(f"""
+        <div class="stream-container" id="stream-div">
+            <p>{text}</p>
+        </div>
+        """, unsafe_allow_html=True)
+
     full_response = ""
+    last_render = time.monotonic()
+    pending_tokens = 0
+    response_json = None
+    # Brace depth and start offset of the JSON object being streamed
+    depth = 0
+    json_start = 0
+    # Both reasoning models get <think> from the chat template, so only
+    # </think> is streamed. Treat the reply as reasoning until it closes,
+    # unless the reply opens directly with the answer object.
+    thinking = True
+    seen_text = False
     
-    # Initialize invoker with user-selected model
-    invoker = ConversationInvoker(st.session_state.llm_model_id, st.session_state.llm_model_tag)
     invoker.add_user_message(prompt)
     
     # Get the stream response
@@ -165,41 +248,115 @@ def ai_decision(human_card, ai_cards):
             delta = chunk['choices'][0]['delta']
             if 'content' in delta:
                 token = delta['content']
+                offset = len(full_response)
                 full_response += token
-                # Update content with enhanced auto-scroll JavaScript
-                stream_placeholder.markdown(f"""
-                <div class="stream-container" id="stream-div">
-                    <p>{full_response}</p>
-                </div>
-                """, unsafe_allow_html=True)
+                pending_tokens += 1
+                # Each render resends the whole response, so batch the updates
+                now = time.monotonic()
+                if pending_tokens >= 16 or now - last_render > 0.05:
+                    render_stream(full_response)
+                    last_render = now
+                    pending_tokens = 0
+
+                # Braces inside the reasoning block are not the answer
+                scan_from = offset
+                if thinking:
+                    think_end = full_response.find('</think>', max(0, offset - len('</think>') + 1))
+                    if think_end != -1:
+                        thinking = False
+                        scan_from = think_end + len('</think>')
+                    elif not seen_text and token.lstrip().startswith('{'):
+                        thinking = False
+                    seen_text = seen_text or bool(token.strip())
+                    if thinking:
+                        continue
+                # Stop reading as soon as the first complete card object arrives
+                for i in range(scan_from, len(full_response)):
+                    c = full_response[i]
+                    if c == '{':
+                        if depth == 0:
+                            json_start = i
+                        depth += 1
+                    elif c == '}' and depth:
+                        depth -= 1
+                        if depth == 0:
+                            response_json = _parse_card_json(full_response[json_start:i + 1])
+                            if response_json is not None:
+                                break
+                if response_json is not None:
+                    break
+    stream_response.close()
+    render_stream(full_response)
     
     try:
-        # Find last JSON object in response
-        json_start = full_response.rfind('{')
-        json_end = full_response.rfind('}') + 1
-        json_str = full_response[json_start:json_end]
-        
-        # Preprocess JSON string - convert single quotes to double
-        json_str = json_str.replace("'", '"')
-        print('Extracted JSON:', json_str)
-        
-        # Parse final response
-        response_json = json.loads(json_str)
+        if response_json is None:
+            # Find last JSON object in response
+            json_start = full_response.rfind('{')
+            json_end = full_response.rfind('}') + 1
+            json_str = full_response[json_start:json_end]
+            
+            # Preprocess JSON string - convert single quotes to double
+            json_str = json_str.replace("'", '"')
+            print('Extracted JSON:', json_str)
+            
+            # Parse final response
+            response_json = orjson.loads(json_str)
         chosen_card = response_json['card']
         
         # Validate card exists in AI's hand
         if chosen_card in ai_cards:
-            return chosen_card
+            # Shared by every session, so only the answer after the reasoning
+            # block (or the end-of-stream fallback) is stored, never a draft
+            cache[cache_key] = chosen_card
         else:
             st.warning(f"AI tried to play invalid card {chosen_card}")
             # Fallback to random valid card
-            return random.choice(ai_cards)
+            chosen_card = random.choice(ai_cards)
             
-    except (json.JSONDecodeError, KeyError) as e:
+    except (orjson.JSONDecodeError, KeyError) as e:
         st.error(f"Failed to parse AI response: {str(e)}")
         # Fallback to random card if parsing fails
-        return random.choice(ai_cards)
+        chosen_card = random.choice(ai_cards)
+
+    # Keep only the played card in the history, not the reasoning
+    invoker.add_assistant_message(orjson.dumps({"card": chosen_card}).decode())
+    return chosen_card
+
+def _round_result(human_card, ai_card):
+    # 1 if the AI wins the round, -1 if the human wins, 0 on a tie
+    human_value = CARD_RANK[human_card]
+    ai_value = CARD_RANK[ai_card]
+    return (ai_value > human_value) - (ai_value < human_value)
 
+def _reply_outcome(human_card, ai_card, ai_cards, human_remaining, score_diff):
+    return _best_outcome(
+        ai_cards - {ai_card},
+        human_remaining,
+        score_diff + _round_result(human_card, ai_card)
+    )
+
+@functools.lru_cache(maxsize=None)
+def _best_outcome(ai_cards, human_cards, score_diff):
+    # (game result, final score margin) for the AI when both sides play optimally
+    if not ai_cards:
+        return ((score_diff > 0) - (score_diff < 0), score_diff)
+    return min(
+        max(_reply_outcome(h, a, ai_cards, human_cards - {h}, score_diff) for a in ai_cards)
+        for h in human_cards
+    )
+
+def policy_decision(human_card, ai_cards, human_remaining, score_diff):
+    # Minimax over the remaining hands, score_diff is AI score minus human score.
+    # Among equally good replies keep the lowest card.
+    ai = frozenset(ai_cards)
+    human = frozenset(human_remaining)
+    return max(
+        ai_cards,
+        key=lambda a: (_reply_outcome(human_card, a, ai, human, score_diff), -CARD_RANK[a])
+    )
+
+# Streamlit drops elements that a rerun does not emit, so the styles are
+# sent once per rerun rather than once per session
 st.markdown(card_style, unsafe_allow_html=True)
 
 # Main container
@@ -216,6 +373,8 @@ with st.container():
             
             # Model selection controls
             st.subheader("Model Settings")
+
+            use_llm = st.checkbox("Use LLM for AI")
             
             # LLM Model radio buttons
             selected_llm = st.radio(
@@ -242,10 +401,25 @@ with st.container():
             if img_file_buffer is not None:
                 # Recognize card
                 image = Image.open(img_file_buffer)
-                recognized_card = recognize_card(image)
+                if use_llm:
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        card_future = executor.submit(
+                            recognize_card, image,
+                            st.session_state.vlm_model_id, st.session_state.vlm_model_tag
+                        )
+                        # Warm up the LLM client while the VLM call is in flight
+                        executor.submit(get_llm, st.session_state.llm_model_id, st.session_state.llm_model_tag)
+                        recognized_card = card_future.result()
+                else:
+                    recognized_card = recognize_card(
+                        image, st.session_state.vlm_model_id, st.session_state.vlm_model_tag
+                    )
                 found = True
                 # Update game state - remove played card
-                if recognized_card in st.session_state.human_cards:
+                if recognized_card is None:
+                    st.warning("Could not recognize the card, please take another picture.")
+                    found = False
+                elif recognized_card in st.session_state.human_cards:
                     st.session_state.human_cards.remove(recognized_card)
                 else:
                     st.warning(f"Card {recognized_card} not found in your hand!")
@@ -253,12 +427,25 @@ with st.container():
                 
                 if found:
                     # AI makes decision
-                    ai_card = ai_decision(recognized_card, st.session_state.ai_cards)
+                    if use_llm:
+                        ai_card = ai_decision(
+                            recognized_card,
+                            st.session_state.ai_cards,
+                            st.session_state.human_cards,
+                            st.session_state.scores
+                        )
+                    else:
+                        ai_card = policy_decision(
+                            recognized_card,
+                            st.session_state.ai_cards,
+                            st.session_state.human_cards,
+                            st.session_state.scores['ai'] - st.session_state.scores['human']
+                        )
                     st.session_state.ai_cards.remove(ai_card)
                     
                     # Determine round winner
-                    human_value = CARD_VALUES.index(recognized_card)
-                    ai_value = CARD_VALUES.index(ai_card)
+                    human_value = CARD_RANK[recognized_card]
+                    ai_value = CARD_RANK[ai_card]
                     
                     if human_value > ai_value:
                         st.session_state.scores['human'] += 1
@@ -290,10 +477,14 @@ with st.container():
             with score_col2:
                 st.metric("AI Score", st.session_state.scores['ai'])
             # Cards display
+            human_hand = "".join(display_card(c) for c in sorted(st.session_state.human_cards, key=CARD_RANK.get))
+            ai_hand = "".join(display_card(c) for c in sorted(st.session_state.ai_cards, key=CARD_RANK.get))
+            table = "".join(display_card(f"{h} vs {a}") for h, a in st.session_state.table_cards)
+
             st.subheader("Your Cards")
-            st.markdown("".join([display_card(c) for c in st.session_state.human_cards]), unsafe_allow_html=True)
+            st.markdown(human_hand, unsafe_allow_html=True)
             
             st.subheader("AI Cards")
-            st.markdown("".join([display_card(c) for c in st.session_state.ai_cards]), unsafe_allow_html=True)
+            st.markdown(ai_hand, unsafe_allow_html=True)
             st.subheader("Table")
-            st.markdown("".join([display_card(f"{h} vs {a}") for h,a in st.session_state.table_cards]), unsafe_allow_html=True)
+            st.markdown(table, unsafe_allow_html=True)